@@ -1,114 +1,287 @@
 import pandas as pd
+import numpy as np
+import csv
 import json
-from io import StringIO
-from datetime import datetime
-import pytz
+import os
+from io import BytesIO, StringIO
+from zoneinfo import ZoneInfo
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pac
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, fall back to pandas and JSON only
+    pa = pac = pq = None
 
-def clean_sleep_data(input_file, output_file):
-    # First, read the file as text to handle the varying number of columns
-    with open(input_file, "r") as f:
-        lines = f.readlines()
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the json module
+    orjson = None
+
+PST = ZoneInfo("America/Los_Angeles")
+DATE_FORMAT = "%d. %m. %Y %H:%M"
+TIME_COLUMNS = ["From", "To", "Sched"]
+# Export columns and the record fields they become, in output order
+BASE_COLUMNS = {
+    "Id": "id",
+    "From": "from_time",
+    "To": "to_time",
+    "Sched": "scheduled_time",
+    "FromMs": "from_time_ms",
+    "ToMs": "to_time_ms",
+    "SchedMs": "scheduled_time_ms",
+    "Hours": "hours",
+    "Rating": "rating",
+    "Cycles": "cycles",
+    "DeepSleep": "deep_sleep",
+    "Geo": "geo",
+}
+FLOAT_COLUMNS = ["Hours", "Rating", "Cycles", "DeepSleep"]
+EXPORT_COLUMNS = [
+    "Id", "Tz", "From", "To", "Sched", "Hours", "Rating", "Cycles", "DeepSleep", "Geo"
+]
+EPOCH = pd.Timestamp(0, tz="UTC")
+
+
+def localize_column(values, tz_names):
+    """Parse a column of local times and return them as PST timestamps.
+
+    Ambiguous and non-existent DST times resolve to standard time.
+    """
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, cache=True)
+
+    # Records can come from different timezones
+    pieces = []
+    for name, index in tz_names.groupby(tz_names).groups.items():
+        local = parsed[index].dt.tz_localize(
+            ZoneInfo(name),  # ZoneInfo caches instances per key
+            ambiguous=np.zeros(len(index), dtype=bool),
+            nonexistent=pd.Timedelta(hours=1),
+        )
+        pieces.append(local.dt.tz_convert(PST))
+    return pd.concat(pieces).reindex(values.index)
+
+
+def isoformat_column(times):
+    """Format timezone-aware timestamps the way datetime.isoformat() does."""
+    # strftime's %z has no colon, isoformat() does
+    formatted = times.dt.strftime("%Y-%m-%dT%H:%M:%S%z")
+    return formatted.str[:-2] + ":" + formatted.str[-2:]
 
-    # Initialize list to store cleaned records
-    cleaned_records = []
 
+def epoch_ms_column(times):
+    """Convert timezone-aware timestamps to milliseconds since the epoch."""
+    return (times - EPOCH) // pd.Timedelta(milliseconds=1)
+
+
+def parse_header(header):
+    """Locate the base, time series and event columns of a header line.
+
+    Returns (base_idx, ts_cols, event_idx, width): the positions of
+    EXPORT_COLUMNS (None when missing), (position, name) pairs for the time
+    series columns, the positions of the event columns, and the column count.
+    """
+    # Name the columns the same way pandas does, so repeated headers such
+    # as "01:30" become "01:30", "01:30.1", ...
+    names = []
+    seen = {}
+    for name in next(csv.reader([header])):
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(f"{name}.{count}" if count else name)
+
+    positions = {name: i for i, name in enumerate(names)}
+    base_idx = [positions.get(col) for col in EXPORT_COLUMNS]
+    ts_cols = [(i, name) for i, name in enumerate(names) if ":" in name]
+    event_idx = [i for i, name in enumerate(names) if name.startswith("Event")]
+    return base_idx, ts_cols, event_idx, len(names)
+
+
+def iter_rows(lines):
+    """Yield (layout, fields) for each data line of the export.
+
+    The header varies in column count across the export (in practice every
+    night has its own), so each data line is split with the csv module and
+    paired with the parse_header() layout of the header before it.
+    """
     current_header = None
-    current_data = None
+    layout = None
 
     for line in lines:
         if line.startswith("Id,"):
             # This is a header line
-            current_header = line.strip()
+            header = line.strip()
+            if header != current_header:
+                current_header = header
+                layout = parse_header(header)
         elif line.strip() and not line.startswith(","):
             # This is a data line
-            current_data = line.strip()
-
-            if current_header and current_data:
-                # Create a single-row DataFrame
-                df = pd.read_csv(StringIO(current_header + "\n" + current_data))
-
-                # Extract base data
-                # Parse timezone
-                tz = pytz.timezone(df["Tz"].iloc[0])
-                pst = pytz.timezone("America/Los_Angeles")
-
-                # Parse dates with timezone
-                from_time = datetime.strptime(df["From"].iloc[0], "%d. %m. %Y %H:%M")
-                from_time = tz.localize(from_time).astimezone(pst)
-
-                to_time = datetime.strptime(df["To"].iloc[0], "%d. %m. %Y %H:%M")
-                to_time = tz.localize(to_time).astimezone(pst)
-
-                sched_time = datetime.strptime(df["Sched"].iloc[0], "%d. %m. %Y %H:%M")
-                sched_time = tz.localize(sched_time).astimezone(pst)
-
-                base_data = {
-                    "id": df["Id"].iloc[0],
-                    "from_time": from_time.isoformat(),
-                    "to_time": to_time.isoformat(),
-                    "scheduled_time": sched_time.isoformat(),
-                    "hours": (
-                        float(df["Hours"].iloc[0])
-                        if pd.notnull(df["Hours"].iloc[0])
-                        else None
-                    ),
-                    "rating": (
-                        float(df["Rating"].iloc[0])
-                        if pd.notnull(df["Rating"].iloc[0])
-                        else None
-                    ),
-                    "cycles": (
-                        float(df["Cycles"].iloc[0])
-                        if pd.notnull(df["Cycles"].iloc[0])
-                        else None
-                    ),
-                    "deep_sleep": (
-                        float(df["DeepSleep"].iloc[0])
-                        if pd.notnull(df["DeepSleep"].iloc[0])
-                        else None
-                    ),
-                    "geo": df["Geo"].iloc[0],
-                }
-
-                # Extract time series data
-                time_series = {}
-                for col in df.columns:
-                    if ":" in str(col):  # If column name contains time
-                        if pd.notnull(df[col].iloc[0]):
-                            time_series[col] = float(df[col].iloc[0])
-
-                # Extract events
-                events = []
-                for col in df.columns:
-                    if str(col).startswith("Event"):
-                        if pd.notnull(df[col].iloc[0]):
-                            # Split on hyphen to get event type and timestamp
-                            event_str = str(df[col].iloc[0])
-                            try:
-                                event_type, timestamp = event_str.split("-", 1)
-                                events.append(
-                                    {"type": event_type, "timestamp": timestamp}
-                                )
-                            except ValueError:
-                                print(f"Warning: Could not parse event: {event_str}")
-                                continue
-
-                # Combine all data
-                record = {**base_data, "time_series": time_series, "events": events}
-
-                cleaned_records.append(record)
-
-    # Write to JSON file
-    class NumpyEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if hasattr(obj, "item"):
-                return obj.item()
-            return super().default(obj)
-
-    with open(output_file, "w") as f:
-        json.dump(cleaned_records, f, indent=2, cls=NumpyEncoder)
+            if layout:
+                fields = next(csv.reader([line.strip()]))
+                # Rows shorter than their header are missing trailing values
+                fields += [""] * (layout[3] - len(fields))
+                yield layout, fields
+
+
+def read_base(rows):
+    """Parse the base column values of every record into one DataFrame."""
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    text_columns = ["Tz", "From", "To", "Sched", "Geo"]
+
+    if pac is None:
+        buffer.seek(0)
+        return pd.read_csv(
+            buffer,
+            names=EXPORT_COLUMNS,
+            header=None,
+            dtype=dict.fromkeys(text_columns, str),
+            engine="c",
+            low_memory=False,
+        )
+
+    table = pac.read_csv(
+        BytesIO(buffer.getvalue().encode()),
+        read_options=pac.ReadOptions(column_names=EXPORT_COLUMNS),
+        convert_options=pac.ConvertOptions(
+            column_types=dict.fromkeys(text_columns, pa.string()),
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+
+def clean_sleep_data(input_file, output_file):
+    # Base column values of every record, plus its time series and events
+    base_rows = []
+    details = []
+
+    # Stream the file; only the base columns go through a CSV parser, once
+    # for the whole export after the loop
+    with open(input_file, "r") as f:
+        for (base_idx, ts_cols, event_idx, _), fields in iter_rows(f):
+            base_rows.append([fields[i] if i is not None else "" for i in base_idx])
+
+            # Extract time series data
+            time_series = {
+                name: float(fields[i]) for i, name in ts_cols if fields[i] != ""
+            }
+
+            # Extract events
+            events = []
+            for i in event_idx:
+                event_str = fields[i]
+                if not event_str:
+                    continue
+                # Split on hyphen to get event type and timestamp
+                try:
+                    event_type, timestamp = event_str.split("-", 1)
+                    events.append({"type": event_type, "timestamp": timestamp})
+                except ValueError:
+                    print(f"Warning: Could not parse event: {event_str}")
+                    continue
+
+            details.append((time_series, events))
+
+    # Initialize list to store cleaned records
+    cleaned_records = []
+
+    if details:
+        base = read_base(base_rows)
+
+        # Parse dates with timezone for all records at once, keeping epoch
+        # milliseconds next to the ISO strings so the analysis step does not
+        # have to parse them again
+        epoch_ms = {}
+        for col in TIME_COLUMNS:
+            times = localize_column(base[col], base["Tz"])
+            base[col] = isoformat_column(times)
+            epoch_ms[col + "Ms"] = epoch_ms_column(times)
+
+        # Cast the base columns once, so each row unpacks straight into
+        # plain Python values with missing values already set to None
+        base = base.assign(**epoch_ms)[list(BASE_COLUMNS)]
+        base = base.astype(dict.fromkeys(FLOAT_COLUMNS, float))
+        base = base.astype(object).where(base.notna(), None)
+
+        for row, (time_series, events) in zip(
+            base.itertuples(index=False, name=None), details
+        ):
+            # Combine all data
+            record = {
+                **dict(zip(BASE_COLUMNS.values(), row)),
+                "time_series": time_series,
+                "events": events,
+            }
+
+            cleaned_records.append(record)
+
+    # Write to JSON file. Records only hold plain Python values, so neither
+    # writer needs a fallback for numpy scalars.
+    if orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(cleaned_records, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, "w") as f:
+            json.dump(cleaned_records, f, indent=2)
+
+    return cleaned_records
+
+
+def write_parquet(records, base_file, events_file):
+    """Write records as one row per night plus a long table of their events."""
+    timestamp = pa.timestamp("ms", tz=PST.key)
+    base = pa.table(
+        {
+            "id": pa.array([r["id"] for r in records], pa.int64()),
+            "from_time": pa.array([r["from_time_ms"] for r in records], timestamp),
+            "to_time": pa.array([r["to_time_ms"] for r in records], timestamp),
+            "scheduled_time": pa.array(
+                [r["scheduled_time_ms"] for r in records], timestamp
+            ),
+            "hours": pa.array([r["hours"] for r in records], pa.float64()),
+            "rating": pa.array([r["rating"] for r in records], pa.float64()),
+            "cycles": pa.array([r["cycles"] for r in records], pa.float64()),
+            "deep_sleep": pa.array([r["deep_sleep"] for r in records], pa.float64()),
+            "geo": pa.array([r["geo"] for r in records], pa.string()),
+            "time_series": pa.array(
+                [list(r["time_series"].items()) for r in records],
+                pa.map_(pa.string(), pa.float64()),
+            ),
+        }
+    )
+    pq.write_table(base, base_file, compression="zstd")
+
+    # Ids can repeat, so events point at their record's row in the base file
+    events = [
+        (record_idx, e["type"], e["timestamp"], *e["timestamp"].partition("-"))
+        for record_idx, r in enumerate(records)
+        for e in r["events"]
+    ]
+    pq.write_table(
+        pa.table(
+            {
+                "record_idx": pa.array([e[0] for e in events], pa.int64()),
+                "type": pa.array([e[1] for e in events], pa.string()),
+                "timestamp": pa.array([e[2] for e in events], pa.string()),
+                # The raw timestamp split into milliseconds and measurement
+                "ts_ms": pa.array([int(e[3]) for e in events], pa.int64()),
+                "value": pa.array(
+                    [float(e[5]) if e[5] else None for e in events], pa.float64()
+                ),
+            }
+        ),
+        events_file,
+        compression="zstd",
+    )
 
 
 # Usage
-clean_sleep_data("sleep-export.csv", "sleep-data-cleaned.json")
+cleaned_records = clean_sleep_data("sleep-export.csv", "sleep-data-cleaned.json")
+if pq is not None:
+    write_parquet(cleaned_records, "sleep_base.parquet", "sleep_events.parquet")
+else:
+    # Remove Parquet files from an earlier run, step 2 would read them first
+    for path in ["sleep_base.parquet", "sleep_events.parquet"]:
+        if os.path.exists(path):
+            os.remove(path)
@@ -5,16 +5,28 @@ Generates a self-contained HTML report with interactive charts focused on key sl
 
 import json
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Optional, Tuple
 import warnings
 
 import pandas as pd
 import plotly.graph_objects as go
+import plotly.io as pio
 import plotly.express as px
 from plotly.subplots import make_subplots
 import numpy as np
 import os
 import click
+from click.core import ParameterSource
+
+try:
+    import polars as pl
+except ImportError:  # polars is optional, fall back to pandas
+    pl = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, fall back to the JSON export
+    pq = None
 
 # Suppress warnings
 warnings.filterwarnings("ignore")
@@ -28,80 +40,220 @@ SLEEP_GUIDELINES = {
     "light_ratio": 0.55,
 }
 
+# Timezone step-1-clean.py converts every record to
+TIMEZONE = "America/Los_Angeles"
+
+# Record fields used by the analysis
+BASE_FIELDS = ["id", "from_time", "to_time", "hours", "deep_sleep"]
+
+# Events that bound interruptions and REM phases
+PAIRED_EVENT_TYPES = {"AWAKE_START", "AWAKE_END", "REM_START", "REM_END"}
+
 
-def load_sleep_data(filename: str, start_date: Optional[datetime] = None) -> List[Dict]:
-    """Load and parse sleep records from JSON file."""
+def load_sleep_data(
+    filename: str, start_date: Optional[datetime] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Load sleep records from JSON file as base and flattened event frames."""
     with open(filename, "r") as f:
         records = json.load(f)
 
+    # Files written before step-1-clean.py added epoch milliseconds only
+    # carry ISO 8601 strings
+    has_ms = all("from_time_ms" in r and "to_time_ms" in r for r in records)
+
     if start_date:
-        records = [
-            r for r in records if datetime.fromisoformat(r["from_time"]) >= start_date
-        ]
+        if has_ms:
+            start_ms = int(local_start(start_date).timestamp() * 1000)
+            records = [r for r in records if r["from_time_ms"] >= start_ms]
+        else:
+            # ISO 8601 strings sort chronologically, so compare them directly
+            # against the start date's wall-clock time
+            start_iso = start_date.isoformat()
+            records = [r for r in records if r["from_time"] >= start_iso]
+
+    base = pd.DataFrame(records, columns=BASE_FIELDS)
+    for field in ["from_time", "to_time"]:
+        if has_ms:
+            ms = [r[f"{field}_ms"] for r in records]
+            base[field] = pd.to_datetime(ms, unit="ms", utc=True)
+        else:
+            base[field] = pd.to_datetime(base[field].astype(object), utc=True)
+    paired = [
+        (record_idx, event)
+        for record_idx, record in enumerate(records)
+        for event in record["events"]
+        if event["type"] in PAIRED_EVENT_TYPES
+    ]
+    events = flatten_events(
+        [record_idx for record_idx, _ in paired],
+        [event["type"] for _, event in paired],
+        [event["timestamp"] for _, event in paired],
+    )
+    return base, events
 
-    return records
 
+def load_parquet_data(
+    base_file: str, events_file: str, start_date: Optional[datetime] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Load sleep records from the Parquet files written by step-1-clean.py."""
+    base = pq.read_table(base_file, columns=BASE_FIELDS).to_pandas()
+    events = pq.read_table(
+        events_file,
+        columns=["record_idx", "type", "ts_ms"],
+        filters=[("type", "in", sorted(PAIRED_EVENT_TYPES))],
+    ).to_pandas()
+    record_idx = events["record_idx"].to_numpy()
 
-def create_analysis_dataframe(records: List[Dict]) -> pd.DataFrame:
-    """Convert sleep records to pandas DataFrame with calculated metrics."""
-    data = []
-
-    for record in records:
-        # Parse dates
-        sleep_time = datetime.fromisoformat(record["from_time"])
-        wake_time = datetime.fromisoformat(record["to_time"])
-
-        # Calculate interruptions
-        interruptions = []
-        current_awake = None
-
-        for event in record["events"]:
-            if event["type"] == "AWAKE_START":
-                current_awake = float(event["timestamp"].split("-")[0]) / 1000
-            elif event["type"] == "AWAKE_END" and current_awake:
-                end_time = float(event["timestamp"]) / 1000
-                duration = (end_time - current_awake) / 60  # Minutes
-                interruptions.append(duration)
-                current_awake = None
-
-        # Calculate REM time
-        rem_events = [
-            e for e in record["events"] if e["type"] in ["REM_START", "REM_END"]
-        ]
-        rem_time = 0
-        for i in range(0, len(rem_events), 2):
-            if i + 1 < len(rem_events):
-                start = float(rem_events[i]["timestamp"].split("-")[0]) / 1000
-                end = float(rem_events[i + 1]["timestamp"].split("-")[0]) / 1000
-                rem_time += (end - start) / 3600  # Hours
-
-        data.append(
-            {
-                "date": sleep_time.date(),
-                "sleep_time": sleep_time.time(),
-                "wake_time": wake_time.time(),
-                "hours": record["hours"],
-                "deep_sleep_hours": (
-                    record["deep_sleep"] * record["hours"]
-                    if record["deep_sleep"] >= 0
-                    else None
-                ),
-                "rem_sleep_hours": rem_time,
-                "light_sleep_hours": (
-                    record["hours"]
-                    - (record["deep_sleep"] * record["hours"])
-                    - rem_time
-                    if record["deep_sleep"] >= 0
-                    else None
-                ),
-                "interruption_count": len(interruptions),
-                "avg_interruption_mins": np.mean(interruptions) if interruptions else 0,
-                "day_of_week": sleep_time.strftime("%A"),
-                "is_weekend": sleep_time.weekday() >= 5,
-            }
+    if start_date:
+        # Keep the events of the remaining records and renumber them
+        kept = (base["from_time"] >= local_start(start_date)).to_numpy()
+        base = base[kept].reset_index(drop=True)
+        events = events[kept[record_idx]]
+        record_idx = (np.cumsum(kept) - 1)[record_idx[kept[record_idx]]]
+
+    # Event times are already stored as integer milliseconds
+    events = event_frame(
+        record_idx, events["type"].to_numpy(), events["ts_ms"].to_numpy()
+    )
+    return base, events
+
+
+def local_start(start_date: datetime) -> pd.Timestamp:
+    """Interpret a naive --start-date as a wall-clock time in TIMEZONE.
+
+    Ambiguous DST times resolve to standard time and missing ones move
+    forward by an hour, like the export times in step-1-clean.py.
+    """
+    return pd.Timestamp(start_date).tz_localize(
+        TIMEZONE, ambiguous=False, nonexistent=pd.Timedelta(hours=1)
+    )
+
+
+def local_times(values: pd.Series) -> pd.Series:
+    """Convert timezone-aware timestamps to naive wall-clock times in TIMEZONE."""
+    return values.dt.tz_convert(TIMEZONE).dt.tz_localize(None)
+
+
+def flatten_events(record_idx, types, timestamps) -> pd.DataFrame:
+    """Build the event DataFrame from record index, type and raw timestamp columns."""
+    # Timestamps may carry a measurement after a hyphen; keep milliseconds
+    # only, and convert them to seconds below so both branches round alike
+    if pl is not None:
+        ms = (
+            pl.Series(timestamps, dtype=pl.String)
+            .str.split_exact("-", 1)
+            .struct.field("field_0")
+            .cast(pl.Float64)
+            .to_numpy()
+        )
+    else:
+        ms = (
+            pd.Series(timestamps, dtype=object)
+            .astype(str)
+            .str.split("-", n=1)
+            .str[0]
+            .astype(float)
+            .to_numpy()
         )
 
-    df = pd.DataFrame(data)
+    return event_frame(record_idx, types, ms)
+
+
+def event_frame(record_idx, types, ms) -> pd.DataFrame:
+    """Build one long event DataFrame with timestamps converted to seconds."""
+    return pd.DataFrame(
+        {
+            "record_idx": np.asarray(record_idx, dtype=np.int64),
+            "type": np.asarray(types, dtype=object),
+            "ts": np.asarray(ms, dtype=float) / 1000,
+        }
+    )
+
+
+def summarize_events(events: pd.DataFrame, record_count: int) -> pd.DataFrame:
+    """Calculate interruption and REM metrics per record from flattened events.
+
+    Events must be grouped by record and kept in their original order.
+    """
+    record_idx = events["record_idx"].to_numpy(dtype=np.int64)
+    types = events["type"].to_numpy(dtype=object)
+    ts = events["ts"].to_numpy(dtype=float)
+
+    # An interruption is an AWAKE_END directly preceded by an AWAKE_START
+    awake = np.isin(types, ["AWAKE_START", "AWAKE_END"])
+    awake_idx, awake_types, awake_ts = record_idx[awake], types[awake], ts[awake]
+    is_interruption = (
+        (awake_types[1:] == "AWAKE_END")
+        & (awake_types[:-1] == "AWAKE_START")
+        & (awake_idx[1:] == awake_idx[:-1])
+    )
+    durations = (awake_ts[1:] - awake_ts[:-1])[is_interruption] / 60  # Minutes
+    owners = awake_idx[1:][is_interruption]
+    interruption_count = np.bincount(owners, minlength=record_count)
+    total_mins = np.bincount(owners, weights=durations, minlength=record_count)
+    avg_interruption_mins = np.divide(
+        total_mins,
+        interruption_count,
+        out=np.zeros(record_count),
+        where=interruption_count > 0,
+    )
+
+    # REM events pair up in order: 1st with 2nd, 3rd with 4th, ...
+    rem = np.isin(types, ["REM_START", "REM_END"])
+    rem_idx, rem_ts = record_idx[rem], ts[rem]
+    group_start = np.flatnonzero(np.r_[True, rem_idx[1:] != rem_idx[:-1]])
+    position = np.arange(len(rem_idx)) - np.repeat(
+        group_start, np.diff(np.r_[group_start, len(rem_idx)])
+    )
+    has_next = np.r_[rem_idx[1:] == rem_idx[:-1], False]
+    is_start = (position % 2 == 0) & has_next
+    rem_hours = (rem_ts[1:] - rem_ts[:-1])[is_start[:-1]] / 3600  # Hours
+    rem_time = np.bincount(
+        rem_idx[is_start], weights=rem_hours, minlength=record_count
+    )
+
+    return pd.DataFrame(
+        {
+            "interruption_count": interruption_count,
+            "avg_interruption_mins": avg_interruption_mins,
+            "rem_sleep_hours": rem_time.astype(float),
+        }
+    )
+
+
+def create_analysis_dataframe(
+    base: pd.DataFrame, events: pd.DataFrame
+) -> pd.DataFrame:
+    """Convert sleep records to pandas DataFrame with calculated metrics."""
+    summary = summarize_events(events, len(base))
+
+    # Dates as wall-clock times in TIMEZONE
+    sleep_time = local_times(base["from_time"])
+    wake_time = local_times(base["to_time"])
+
+    hours = base["hours"].astype(float)
+    deep_sleep = base["deep_sleep"].astype(float)
+    deep_sleep_hours = (deep_sleep * hours).where(deep_sleep >= 0)
+    rem_time = summary["rem_sleep_hours"]
+    weekday = sleep_time.dt.weekday
+
+    df = pd.DataFrame(
+        {
+            "date": sleep_time.dt.date,
+            "sleep_time": sleep_time,
+            "wake_time": wake_time,
+            "sleep_hour": sleep_time.dt.hour + sleep_time.dt.minute / 60,
+            "wake_hour": wake_time.dt.hour + wake_time.dt.minute / 60,
+            "hours": hours,
+            "deep_sleep_hours": deep_sleep_hours,
+            "rem_sleep_hours": rem_time,
+            "light_sleep_hours": hours - deep_sleep_hours - rem_time,
+            "interruption_count": summary["interruption_count"],
+            "avg_interruption_mins": summary["avg_interruption_mins"],
+            "weekday": weekday,  # Monday is 0
+            "is_weekend": weekday >= 5,
+        }
+    )
     df.set_index("date", inplace=True)
     return df
 
@@ -116,12 +268,12 @@ def create_html_report(df: pd.DataFrame, output_file: str):
     consistency_fig.add_trace(
         go.Scatter(
             x=df.index,
-            y=[t.hour + t.minute/60 for t in df["sleep_time"]],
+            y=df["sleep_hour"],
             mode="markers+lines",
             name="Sleep Time",
             line=dict(color="#2E86C1"),
             hovertemplate="Sleep Time: %{text}<br>Date: %{x}",
-            text=[t.strftime("%I:%M %p") for t in df["sleep_time"]]
+            text=df["sleep_time"].dt.strftime("%I:%M %p")
         )
     )
     
@@ -129,18 +281,18 @@ def create_html_report(df: pd.DataFrame, output_file: str):
     consistency_fig.add_trace(
         go.Scatter(
             x=df.index,
-            y=[t.hour + t.minute/60 for t in df["wake_time"]],
+            y=df["wake_hour"],
             mode="markers+lines", 
             name="Wake Time",
             line=dict(color="#E74C3C"),
             hovertemplate="Wake Time: %{text}<br>Date: %{x}",
-            text=[t.strftime("%I:%M %p") for t in df["wake_time"]]
+            text=df["wake_time"].dt.strftime("%I:%M %p")
         )
     )
 
     # Calculate standard deviations for sleep consistency score
-    sleep_std = pd.Series([t.hour + t.minute/60 for t in df["sleep_time"]]).std()
-    wake_std = pd.Series([t.hour + t.minute/60 for t in df["wake_time"]]).std()
+    sleep_std = df["sleep_hour"].std()
+    wake_std = df["wake_hour"].std()
     consistency_score = 100 * (1 - (sleep_std + wake_std)/(24))  # Higher score = more consistent
 
     consistency_fig.update_layout(
@@ -200,7 +352,7 @@ def create_html_report(df: pd.DataFrame, output_file: str):
     stages_fig.update_layout(title="Average Sleep Stage Distribution")
 
     # 3. Weekly Pattern
-    weekly_avg = df.groupby("day_of_week")["hours"].mean()
+    weekly_avg = df.groupby("weekday")["hours"].mean().reindex(range(7))
     days = [
         "Monday",
         "Tuesday",
@@ -210,10 +362,9 @@ def create_html_report(df: pd.DataFrame, output_file: str):
         "Saturday",
         "Sunday",
     ]
-    weekly_avg = weekly_avg.reindex(days)
 
     weekly_fig = go.Figure(
-        data=[go.Bar(x=weekly_avg.index, y=weekly_avg.values, marker_color="#2E86C1")]
+        data=[go.Bar(x=days, y=weekly_avg.values, marker_color="#2E86C1")]
     )
 
     weekly_fig.update_layout(
@@ -223,20 +374,10 @@ def create_html_report(df: pd.DataFrame, output_file: str):
     )
 
     # 4. Sleep Time Distribution
-    def time_to_hours(t):
-        return t.hour + t.minute / 60
-
-    timing_data = pd.DataFrame(
-        {
-            "Sleep Time": df["sleep_time"].apply(time_to_hours),
-            "Wake Time": df["wake_time"].apply(time_to_hours),
-        }
-    )
-
     sleep_fig = go.Figure()
     sleep_fig.add_trace(
         go.Violin(
-            y=timing_data["Sleep Time"],
+            y=df["sleep_hour"],
             name="Sleep Time",
             line_color="#2E86C1",
         )
@@ -251,7 +392,7 @@ def create_html_report(df: pd.DataFrame, output_file: str):
     wake_fig = go.Figure()
     wake_fig.add_trace(
         go.Violin(
-            y=timing_data["Wake Time"],
+            y=df["wake_hour"],
             name="Wake Time",
             line_color="#E74C3C",
         )
@@ -383,30 +524,31 @@ def create_html_report(df: pd.DataFrame, output_file: str):
         </div>
 
         <script>
-            var durationData = {duration_fig.to_json()};
-            Plotly.newPlot('duration-chart', durationData.data, durationData.layout);
-            
-            var stagesData = {stages_fig.to_json()};
-            Plotly.newPlot('stages-chart', stagesData.data, stagesData.layout);
-            
-            var weeklyData = {weekly_fig.to_json()};
-            Plotly.newPlot('weekly-chart', weeklyData.data, weeklyData.layout);
-            
-            var sleepData = {sleep_fig.to_json()};
-            Plotly.newPlot('sleep-chart', sleepData.data, sleepData.layout);
-            
-            var wakeData = {wake_fig.to_json()};
-            Plotly.newPlot('wake-chart', wakeData.data, wakeData.layout);
-            
-            var consistencyData = {consistency_fig.to_json()};
-            Plotly.newPlot('consistency-chart', consistencyData.data, consistencyData.layout);
-        </script>
-    </body>
-    </html>
-    """
+"""
+
+    # Charts are embedded in page order. Each figure's JSON is encoded
+    # right before it is written, so the page is never held in memory whole.
+    charts = [
+        ("durationData", "duration-chart", duration_fig),
+        ("stagesData", "stages-chart", stages_fig),
+        ("weeklyData", "weekly-chart", weekly_fig),
+        ("sleepData", "sleep-chart", sleep_fig),
+        ("wakeData", "wake-chart", wake_fig),
+        ("consistencyData", "consistency-chart", consistency_fig),
+    ]
 
     with open(output_file, "w") as f:
         f.write(html_content)
+        for i, (var_name, chart_id, fig) in enumerate(charts):
+            if i:
+                f.write("            \n")
+            f.write(f"            var {var_name} = ")
+            f.write(pio.to_json(fig, validate=False, pretty=False))
+            f.write(
+                f";\n            Plotly.newPlot('{chart_id}', "
+                f"{var_name}.data, {var_name}.layout);\n"
+            )
+        f.write("        </script>\n    </body>\n    </html>\n    ")
 
 
 @click.command()
@@ -418,23 +560,45 @@ def create_html_report(df: pd.DataFrame, output_file: str):
 @click.option(
     "--input-file",
     default="sleep-data-cleaned.json",
-    help="Input JSON file path",
+    help="Input JSON file path; when omitted, the Parquet files are used if present",
+)
+@click.option(
+    "--base-file",
+    default="sleep_base.parquet",
+    help="Input Parquet file with one row per sleep record",
+)
+@click.option(
+    "--events-file",
+    default="sleep_events.parquet",
+    help="Input Parquet file with the events of each sleep record",
 )
 @click.option(
     "--output-file",
     default="./analysis/index.html",
     help="Output HTML file path",
 )
-def main(start_date, input_file, output_file):
+def main(start_date, input_file, base_file, events_file, output_file):
     """Analyze sleep data and generate interactive HTML report."""
     # Create analysis directory if it doesn't exist
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
+    # Prefer the Parquet files, unless a JSON file was asked for explicitly
+    input_source = click.get_current_context().get_parameter_source("input_file")
+    use_parquet = (
+        input_source is ParameterSource.DEFAULT
+        and pq is not None
+        and os.path.exists(base_file)
+        and os.path.exists(events_file)
+    )
+
     print("Loading sleep data...")
-    records = load_sleep_data(input_file, start_date)
+    if use_parquet:
+        base, events = load_parquet_data(base_file, events_file, start_date)
+    else:
+        base, events = load_sleep_data(input_file, start_date)
 
     print("Analyzing sleep patterns...")
-    df = create_analysis_dataframe(records)
+    df = create_analysis_dataframe(base, events)
 
     print("Generating interactive report...")
     create_html_report(df, output_file)